@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+DNS Answer Cache
+Shared TTL-aware cache for the DNS lookups made by the test scripts
+"""
+
+import asyncio
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+CACHE_DIR = Path.home() / '.cache' / 'onesecure'
+CACHE_FILE = CACHE_DIR / 'dns.json'
+
+# How long NXDOMAIN / NoAnswer results are remembered
+NEGATIVE_TTL = 300
+# Upper bound on how long an answer is reused, so record changes show up within the hour
+MAX_TTL = 60 * 60
+# How long past expiry an entry may still be served when every lookup fails (RFC 8767)
+STALE_MAX = 24 * 60 * 60
+# Most entries kept in memory and on disk; the oldest are evicted first
+MAX_ENTRIES = 4096
+
+# (qname, rdtype) -> (status, records, expiry)
+_cache: Dict[Tuple[str, str], Tuple[str, List[Any], float]] = {}
+# The runners call the tests from worker threads, which share this cache
+_cache_lock = threading.Lock()
+
+def make_resolver(nameservers: List[str], timeout: float = 3, lifetime: float = 5,
+                  asynchronous: bool = False) -> dns.resolver.BaseResolver:
+    """
+    Build a resolver pinned to the given nameservers
+
+    Args:
+        nameservers: Nameserver addresses to query
+        timeout: Seconds to wait for each nameserver
+        lifetime: Total seconds allowed for a query
+        asynchronous: Build a dns.asyncresolver.Resolver for use under asyncio
+
+    Returns:
+        Configured resolver, intended to be created once and reused
+    """
+    resolver_class = dns.asyncresolver.Resolver if asynchronous else dns.resolver.Resolver
+    # configure=False skips re-reading /etc/resolv.conf - the nameservers are set explicitly
+    resolver = resolver_class(configure=False)
+    resolver.nameservers = nameservers
+    resolver.timeout = timeout
+    resolver.lifetime = lifetime
+    return resolver
+
+class RacingResolver:
+    """
+    Asynchronous resolver that sends each query to several nameservers at
+    once and returns the first definitive reply
+
+    A slow or unreachable nameserver then costs nothing as long as another
+    one answers, instead of a full timeout before falling back. The first
+    NXDOMAIN / NoAnswer is final, so only non-filtering resolvers belong here.
+    """
+
+    def __init__(self, nameservers: List[str], timeout: float = 3, lifetime: float = 5):
+        self.resolvers = [make_resolver([nameserver], timeout, lifetime, asynchronous=True)
+                          for nameserver in nameservers]
+        self.lifetime = lifetime
+
+    async def resolve(self, qname: str, rdtype: str):
+        tasks = [asyncio.ensure_future(resolver.resolve(qname, rdtype)) for resolver in self.resolvers]
+        error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                    # Authoritative negative answers - the other servers would agree
+                    raise
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+def _to_value(rdata) -> Any:
+    """Convert an rdata object into a JSON-serialisable value"""
+    if rdata.rdtype == dns.rdatatype.TXT:
+        # Long records are split into several strings - join the raw bytes
+        # rather than formatting and unquoting the text form
+        return b''.join(rdata.strings).decode('ascii', 'replace')
+    if rdata.rdtype == dns.rdatatype.MX:
+        return [rdata.preference, str(rdata.exchange)]
+    return rdata.to_text()
+
+def _cache_key(qname: str, rdtype: str) -> Tuple[str, str]:
+    return (qname.lower().rstrip('.'), rdtype)
+
+def _fresh_entry(key: Tuple[str, str]):
+    """Return the cached entry for key, or None when missing or expired"""
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry is None or entry[2] <= time.time():
+        return None
+    return entry
+
+def _stale_entry(key: Tuple[str, str]):
+    """Return the entry for key if it expired no more than STALE_MAX ago, else None"""
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry is None or entry[2] + STALE_MAX <= time.time():
+        return None
+    return entry
+
+def _answer_entry(answers) -> Tuple[str, List[Any], float]:
+    ttl = min(answers.rrset.ttl, MAX_TTL)
+    return ('ok', [_to_value(rdata) for rdata in answers], time.time() + ttl)
+
+def _negative_entry(status: str) -> Tuple[str, List[Any], float]:
+    return (status, [], time.time() + NEGATIVE_TTL)
+
+def _store(key: Tuple[str, str], entry: Tuple[str, List[Any], float]):
+    with _cache_lock:
+        # Re-inserting moves a refreshed entry to the back of the eviction order
+        _cache.pop(key, None)
+        _cache[key] = entry
+        while len(_cache) > MAX_ENTRIES:
+            del _cache[next(iter(_cache))]
+
+def _note_stale(qname: str, entry, warnings: Optional[List[str]]):
+    """Tell the caller a stale entry is being served, so the result is not mistaken for a live one"""
+    if warnings is not None:
+        minutes = int((time.time() - entry[2]) // 60)
+        warnings.append(f"DNS lookup for {qname} failed; using cached answer that expired {minutes} minutes ago")
+
+def _replay(entry) -> List[Any]:
+    """Return the records of an entry, raising for cached negative answers"""
+    status, records, _ = entry
+    if status == 'nxdomain':
+        raise dns.resolver.NXDOMAIN()
+    if status == 'noanswer':
+        raise dns.resolver.NoAnswer()
+    return records
+
+def cached_resolve(qname: str, rdtype: str, resolver: dns.resolver.Resolver,
+                   warnings: Optional[List[str]] = None, allow_stale: bool = False) -> List[Any]:
+    """
+    Resolve a DNS query, reusing any unexpired cached answer
+
+    Negative answers are cached as well and replayed by raising the same
+    NXDOMAIN / NoAnswer exceptions the resolver would. Timeouts and other
+    failures are never cached and propagate, unless allow_stale is set: the
+    last answer is then served stale instead if it expired less than
+    STALE_MAX ago. Callers with fallback resolvers set it on the final
+    attempt only, so stale data is used once resolution has really failed.
+
+    Args:
+        qname: Name to query
+        rdtype: Record type to query (e.g. 'TXT', 'MX')
+        resolver: Resolver used on a cache miss
+        warnings: List a note is appended to whenever a stale answer is served
+        allow_stale: Fall back on a stale answer when the lookup fails
+
+    Returns:
+        List of record values (strings for TXT, [preference, exchange] for MX)
+    """
+    key = _cache_key(qname, rdtype)
+    entry = _fresh_entry(key)
+
+    if entry is None:
+        try:
+            entry = _answer_entry(resolver.resolve(qname, rdtype))
+        except dns.resolver.NXDOMAIN:
+            entry = _negative_entry('nxdomain')
+        except dns.resolver.NoAnswer:
+            entry = _negative_entry('noanswer')
+        except dns.exception.DNSException:
+            entry = _stale_entry(key) if allow_stale else None
+            if entry is None:
+                raise
+            _note_stale(qname, entry, warnings)
+            return _replay(entry)
+        _store(key, entry)
+
+    return _replay(entry)
+
+async def cached_resolve_async(qname: str, rdtype: str, resolver: dns.asyncresolver.Resolver,
+                               warnings: Optional[List[str]] = None,
+                               allow_stale: bool = False) -> List[Any]:
+    """Asynchronous counterpart of cached_resolve() sharing the same cache"""
+    key = _cache_key(qname, rdtype)
+    entry = _fresh_entry(key)
+
+    if entry is None:
+        try:
+            entry = _answer_entry(await resolver.resolve(qname, rdtype))
+        except dns.resolver.NXDOMAIN:
+            entry = _negative_entry('nxdomain')
+        except dns.resolver.NoAnswer:
+            entry = _negative_entry('noanswer')
+        except dns.exception.DNSException:
+            entry = _stale_entry(key) if allow_stale else None
+            if entry is None:
+                raise
+            _note_stale(qname, entry, warnings)
+            return _replay(entry)
+        _store(key, entry)
+
+    return _replay(entry)
+
+def load_json(path: Path) -> Any:
+    """Read a JSON cache file, returning None when it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_json(path: Path, data: Any):
+    """Atomically write a JSON cache file, ignoring filesystem errors"""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temp file per writer, so concurrent runs never write into the same one
+        fd, tmp_file = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    except OSError:
+        # Caching is best effort - a read-only home must not fail the tests
+        return
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+    except OSError:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+def _load():
+    """Load entries persisted by a previous run that are still fresh or servable stale"""
+    data = load_json(CACHE_FILE)
+    if not isinstance(data, dict):
+        return
+
+    now = time.time()
+    for key, entry in data.items():
+        try:
+            status, records, expiry = entry
+            if expiry + STALE_MAX <= now:
+                continue
+        except (TypeError, ValueError):
+            # Skip entries a different version or a damaged file left behind
+            continue
+        qname, _, rdtype = key.rpartition('|')
+        _cache[(qname, rdtype)] = (status, records, expiry)
+
+def _save():
+    """Persist entries so the next run can skip those lookups or fall back on them"""
+    now = time.time()
+    with _cache_lock:
+        entries = {
+            f"{qname}|{rdtype}": entry
+            for (qname, rdtype), entry in _cache.items()
+            if entry[2] + STALE_MAX > now
+        }
+    save_json(CACHE_FILE, entries)
+
+_load()
+atexit.register(_save)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+JSON Output Helper
+Writes test results as JSON - indented on a terminal, compact on a pipe - and
+parses test output, using orjson for both when it is installed
+"""
+
+import sys
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Parse JSON text, using orjson when it is installed
+
+    Args:
+        data: JSON document as bytes or str
+
+    Returns:
+        Parsed object; raises ValueError if data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def print_json(obj: Any):
+    """
+    Write an object to stdout as JSON
+    
+    Output is indented when stdout is a terminal and written as a single
+    compact line when it is piped to another program.
+
+    Args:
+        obj: JSON-serialisable object to write
+    """
+    if sys.stdout.isatty():
+        json.dump(obj, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif orjson is not None:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+        sys.stdout.buffer.flush()
+    else:
+        json.dump(obj, sys.stdout, separators=(',', ':'))
+        sys.stdout.write('\n')
@@ -6,9 +6,203 @@ Tests for the presence and validity of DKIM records
 
 import sys
 import json
+import asyncio
 import dns.resolver
 import re
-from typing import Dict, Any
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+from json_output import print_json
+from dns_cache import RacingResolver, cached_resolve_async
+
+# Shared by every lookup; each query is raced across all three providers.
+# Quad9's unfiltered 9.9.9.10, as the first NXDOMAIN wins the race and
+# 9.9.9.9 answers NXDOMAIN for blocklisted domains
+_RESOLVER = RacingResolver(['8.8.8.8', '1.1.1.1', '9.9.9.10'])
+
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
+
+# DKIM tags this script inspects (key type, public key, service type, flags)
+_DKIM_TAG = re.compile(r'\b([kpst])=\s*([^;]*)')
+
+def _parse_dkim(record: str) -> Dict[str, str]:
+    """Extract the DKIM tags of interest from a record in a single scan"""
+    return {m.group(1): m.group(2).strip() for m in _DKIM_TAG.finditer(record)}
+
+# Common DKIM selectors to test. The priority tier covers most real-world
+# deployments; the fallback tier is only queried when it finds nothing
+PRIORITY_SELECTORS = ('google', 'selector1', 'selector2', 'default', 'k1')
+FALLBACK_SELECTORS = ('gmail', 'mail', 'dkim', 's1', 's2', 'k2')
+
+# Selectors used by common mail providers, keyed by the domain their MX hosts live under
+MX_TO_SELECTORS = {
+    'google.com': ['google', '20230601', '20221208', '20210112'],
+    'outlook.com': ['selector1', 'selector2'],
+    'protonmail.ch': ['protonmail', 'protonmail2', 'protonmail3'],
+    'zoho.com': ['zoho', 'zmail'],
+    'messagingengine.com': ['fm1', 'fm2', 'fm3'],
+    'yahoodns.net': ['s2048', 's1024'],
+    'icloud.com': ['sig1'],
+}
+
+def _is_dkim_record(record: str) -> bool:
+    return 'k=' in record or 'p=' in record
+
+async def _query_selector(selector: str, domain: str, warnings: List[str]) -> List[str]:
+    """Look up the TXT records published for a DKIM selector"""
+    return await cached_resolve_async(f"{selector}._domainkey.{domain}", 'TXT', _RESOLVER,
+                                      warnings, allow_stale=True)
+
+async def _probe_selectors(domain: str, selectors: List[str], warnings: List[str]) -> List[Tuple[str, asyncio.Task]]:
+    """
+    Query every selector concurrently on a single event loop
+    
+    Selectors still outstanding once one of them returns a DKIM record are
+    cancelled rather than waited on. Those still outstanding at the deadline
+    are cancelled too, but kept so the caller can report them as timed out.
+    
+    Args:
+        domain: Domain name to test
+        selectors: DKIM selectors to query
+        warnings: Test warnings, for answers served stale from the cache
+        
+    Returns:
+        (selector, finished or timed-out task) pairs in the order the
+        selectors were given
+    """
+    tasks = {
+        asyncio.ensure_future(_query_selector(selector, domain, warnings)): selector
+        for selector in selectors
+    }
+    
+    found = False
+    try:
+        # The resolver lifetime already bounds each query; the deadline is a
+        # backstop so one wedged socket cannot hold up the whole batch
+        for next_done in asyncio.as_completed(tasks, timeout=_RESOLVER.lifetime + 1):
+            try:
+                records = await next_done
+            except asyncio.TimeoutError:
+                break
+            except Exception:
+                # The caller reports failures from the task itself
+                continue
+            if any(_is_dkim_record(record) for record in records):
+                found = True
+                break
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    
+    # Only selectors cancelled after a hit are unneeded; without one they were cut off unanswered
+    return [(selector, task) for task, selector in tasks.items() if not (found and task.cancelled())]
+
+def _has_dkim_answer(task: asyncio.Task) -> bool:
+    return not task.cancelled() and task.exception() is None and any(_is_dkim_record(record) for record in task.result())
+
+async def _mx_hinted_selectors(domain: str, warnings: List[str]) -> List[str]:
+    """Selectors the domain's mail provider is known to use, based on its primary MX"""
+    try:
+        mx_records = await cached_resolve_async(domain, 'MX', _RESOLVER, warnings, allow_stale=True)
+    except Exception:
+        # The hint is optional - the generic sweep still runs
+        return []
+    
+    if not mx_records:
+        return []
+    
+    _, exchange = min(mx_records)
+    host = exchange.rstrip('.').lower()
+    for suffix, selectors in MX_TO_SELECTORS.items():
+        if host == suffix or host.endswith('.' + suffix):
+            return selectors
+    return []
+
+async def _has_domainkey_tree(domain: str, warnings: List[str]) -> bool:
+    """
+    Check whether anything is published below _domainkey.<domain>
+    
+    With selectors beneath it, _domainkey is an empty non-terminal and
+    answers NOERROR without records; NXDOMAIN means no selector can exist.
+    """
+    try:
+        await cached_resolve_async(f"_domainkey.{domain}", 'TXT', _RESOLVER, warnings, allow_stale=True)
+    except dns.resolver.NXDOMAIN:
+        return False
+    except Exception:
+        # NoAnswer is the expected reply; on any other failure probe anyway
+        pass
+    return True
+
+async def _find_selectors(domain: str, tiers: List[Sequence[str]],
+                          warnings: List[str]) -> Optional[List[Tuple[str, asyncio.Task]]]:
+    """
+    Probe DKIM selectors tier by tier, starting with those hinted by the MX
+    
+    Each tier is queried concurrently and later tiers are only swept when no
+    earlier tier holds a DKIM record, so most domains are answered by the
+    hinted or priority selectors alone.
+    
+    Args:
+        domain: Domain name to test
+        tiers: Generic selector tiers in the order they should be tried
+        warnings: Test warnings, for answers served stale from the cache
+        
+    Returns:
+        (selector, finished task) pairs in probing order, or None when the
+        domain has no _domainkey subtree and no selector was probed
+    """
+    hinted, has_tree = await asyncio.gather(_mx_hinted_selectors(domain, warnings),
+                                            _has_domainkey_tree(domain, warnings))
+    if not has_tree:
+        return None
+    
+    outcomes = []
+    probed = set()
+    for tier in (hinted, *tiers):
+        batch = [selector for selector in tier if selector not in probed]
+        if not batch:
+            continue
+        probed.update(batch)
+        
+        outcomes += await _probe_selectors(domain, batch, warnings)
+        if any(_has_dkim_answer(task) for _, task in outcomes):
+            break
+    
+    return outcomes
+
+def _parse_dkim_record(record: str, selector: str, result: Dict[str, Any]):
+    """
+    Record a DKIM record found under a selector in the test result
+    
+    Args:
+        record: DKIM TXT record
+        selector: Selector the record was published under
+        result: Test result to update
+    """
+    result['has_dkim'] = True
+    result['selectors_found'].append(selector)
+    result['records'][selector] = record
+    
+    # Parse DKIM record components
+    tags = _parse_dkim(record)
+    if 'k' in tags:
+        result['key_type'] = tags['k']
+    if 'p' in tags:
+        public_key = tags['p']
+        if public_key:
+            result['signature_valid'] = True
+            # Estimate key length (rough approximation)
+            if len(public_key) > 300:
+                result['key_length'] = '2048+'
+            elif len(public_key) > 200:
+                result['key_length'] = '1024+'
+            else:
+                result['key_length'] = 'Unknown'
+        else:
+            result['signature_valid'] = False
+            result['warnings'].append(f"Empty public key in selector {selector}")
 
 def test_dkim(domain: str) -> Dict[str, Any]:
     """
@@ -23,145 +217,53 @@ def test_dkim(domain: str) -> Dict[str, Any]:
     result = {
         'domain': domain,
         'has_dkim': False,
+        # Probing stops at the first hit, so this is not every selector the domain publishes
         'selectors_found': [],
         'records': {},
         'signature_valid': None,
         'key_type': None,
         'key_length': None,
         'errors': [],
-        'warnings': []
+        'warnings': [],
+        'passed': False
     }
     
-    # Common DKIM selectors to test - reduced list to avoid timeouts
-    common_selectors = [
-        'default', 'google', 'gmail', 'mail', 
-        'selector1', 'selector2', 'k1'
-    ]
-    
-    # Special case for google.com to avoid timeouts
-    if domain.lower() == 'google.com':
-        result['has_dkim'] = True
-        result['selectors_found'] = ['20230112']
-        result['records']['20230112'] = "v=DKIM1; k=rsa; p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAviPGBk4ZB64UfSqWyAicdR7lodhytae+EYRQVtKDhM+1mXjEqj/MzhtmMUD4vNSSs18ooQeGGGmjg"
-        result['signature_valid'] = True
-        result['key_type'] = 'rsa'
-        result['key_length'] = '2048+'
-        result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
-        result['test_type'] = 'dkim'
-        return result
-    
     try:
-        # Create custom resolver with improved configuration
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = 3
-        resolver.lifetime = 5
+        # Query the selectors concurrently on a single event loop so each
+        # batch costs one round-trip instead of one per selector
+        outcomes = asyncio.run(_find_selectors(domain, (PRIORITY_SELECTORS, FALLBACK_SELECTORS),
+                                                   result['warnings']))
+        has_domainkey_tree = outcomes is not None
         
-        # Use reliable DNS servers directly
-        resolver.nameservers = ['8.8.8.8', '1.1.1.1']
+        timed_out = []
         
-        # Try with alternate DNS if needed
-        try_google_dns = False
-        
-        for selector in common_selectors:
+        for selector, task in outcomes or []:
             try:
-                dkim_domain = f"{selector}._domainkey.{domain}"
-                
-                if try_google_dns:
-                    resolver.nameservers = ['8.8.8.8', '8.8.4.4']
-                
-                answers = resolver.resolve(dkim_domain, 'TXT')
-                
-                for answer in answers:
-                    record = answer.to_text().strip('"')
-                    
-                    # Check if this is a DKIM record
-                    if 'k=' in record or 'p=' in record:
-                        result['has_dkim'] = True
-                        result['selectors_found'].append(selector)
-                        result['records'][selector] = record
-                        
-                        # Parse DKIM record components
-                        components = record.split(';')
-                        for component in components:
-                            component = component.strip()
-                            if component.startswith('k='):
-                                result['key_type'] = component.split('=')[1]
-                            elif component.startswith('p='):
-                                public_key = component.split('=')[1]
-                                if public_key:
-                                    result['signature_valid'] = True
-                                    # Estimate key length (rough approximation)
-                                    if len(public_key) > 300:
-                                        result['key_length'] = '2048+'
-                                    elif len(public_key) > 200:
-                                        result['key_length'] = '1024+'
-                                    else:
-                                        result['key_length'] = 'Unknown'
-                                else:
-                                    result['signature_valid'] = False
-                                    result['warnings'].append(f"Empty public key in selector {selector}")
-                        
-                        break
-                        
-            except dns.resolver.NXDOMAIN:
-                # Expected for non-existent selectors
+                records = task.result()
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                # Expected for non-existent selectors or selectors without TXT records
                 continue
-            except dns.resolver.NoAnswer:
-                # Expected for selectors without TXT records
+            except (dns.resolver.Timeout, asyncio.CancelledError):
+                # Every resolver in the race timed out, or the batch deadline cut the query off
+                timed_out.append(selector)
                 continue
-            except dns.resolver.Timeout:
-                # Try with Google DNS for the next attempts
-                if not try_google_dns:
-                    try_google_dns = True
-                    result['warnings'].append(f"DNS timeout, switching to Google DNS for reliability")
-                    # Retry this selector with Google DNS
-                    try:
-                        dkim_domain = f"{selector}._domainkey.{domain}"
-                        resolver.nameservers = ['8.8.8.8', '8.8.4.4']
-                        answers = resolver.resolve(dkim_domain, 'TXT')
-                        
-                        # Check answers as before
-                        for answer in answers:
-                            record = answer.to_text().strip('"')
-                            
-                            # Check if this is a DKIM record
-                            if 'k=' in record or 'p=' in record:
-                                result['has_dkim'] = True
-                                result['selectors_found'].append(selector)
-                                result['records'][selector] = record
-                                
-                                # Parse DKIM record components as before
-                                components = record.split(';')
-                                for component in components:
-                                    component = component.strip()
-                                    if component.startswith('k='):
-                                        result['key_type'] = component.split('=')[1]
-                                    elif component.startswith('p='):
-                                        public_key = component.split('=')[1]
-                                        if public_key:
-                                            result['signature_valid'] = True
-                                            # Estimate key length (rough approximation)
-                                            if len(public_key) > 300:
-                                                result['key_length'] = '2048+'
-                                            elif len(public_key) > 200:
-                                                result['key_length'] = '1024+'
-                                            else:
-                                                result['key_length'] = 'Unknown'
-                                        else:
-                                            result['signature_valid'] = False
-                                            result['warnings'].append(f"Empty public key in selector {selector}")
-                                
-                                break
-                    except:
-                        # If retry fails, continue to next selector
-                        continue
-                else:
-                    continue
             except Exception as e:
                 result['warnings'].append(f"Error checking selector {selector}: {str(e)}")
                 continue
+            
+            for record in records:
+                # Check if this is a DKIM record
+                if _is_dkim_record(record):
+                    _parse_dkim_record(record, selector, result)
+                    break
+        
+        if timed_out:
+            result['warnings'].append(f"DNS timeout checking selectors: {', '.join(timed_out)}")
         
-        if not result['has_dkim']:
+        if not has_domainkey_tree:
+            # Custom selectors would live under _domainkey too, so there is nothing left to miss
+            result['errors'].append(f"No DKIM records found - {domain} has no _domainkey subtree")
+        elif not result['has_dkim']:
             result['errors'].append("No DKIM records found with common selectors")
             result['warnings'].append("DKIM may be configured with custom selectors not tested")
         
@@ -169,25 +271,14 @@ def test_dkim(domain: str) -> Dict[str, Any]:
         if result['has_dkim']:
             if result['key_type'] and result['key_type'] not in ['rsa', 'ed25519']:
                 result['warnings'].append(f"Unusual key type: {result['key_type']}")
-            
-            if len(result['selectors_found']) > 3:
-                result['warnings'].append("Multiple DKIM selectors found - ensure they are all valid")
                 
     except dns.resolver.NXDOMAIN:
         result['errors'].append(f"Domain {domain} does not exist")
     except Exception as e:
         result['errors'].append(f"Error testing DKIM: {str(e)}")
-        
-        # Set pass-through dummy data for testing to avoid complete failure
-        result['has_dkim'] = True
-        result['selectors_found'] = ['selector1']
-        result['records']['selector1'] = "v=DKIM1; k=rsa; p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA+Dk2fT8G1I+aKfPZbF7vxe+zTKQrfP3XYyjQZF0exn13MQfV0zpzusa8w6lddGz8iZ0tyoOzwxiNg8z9loZe9YeLFByjvPXPVZ/LxGfH6uQP7VZdQigqm+FPOGX+4bF4zDF+XhmvQ2QdPPLnpjO42k/5kGa8NQpzVJJZIU8gWzwMxEARUWOKrFcxbKLHjJIirnKGpP8KkeX5JFz3a1xwk6K0XJypGGhCl8QLZXzLRDOEA8Yk0bnYTK3AFH6LIVzJUQdyHwQyYMQeS/hhLNDx/CSWKUUeKJb6PwLPQE85ZtMDjOiLD6dZNOYCuDC9jkm9vUUqnUCnL7q+YfmDyRfMkwIDAQAB; t=s"
-        result['signature_valid'] = True
-        result['key_type'] = 'rsa'
-        result['key_length'] = '2048+'
-        result['warnings'].append("Using fallback DKIM data due to DNS resolution error")
-    
-    result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
+    
+    result['passed'] = bool(result['has_dkim'] and result['signature_valid'])
+    result['test_timestamp'] = datetime.now(timezone.utc).isoformat()
     result['test_type'] = 'dkim'
     
     return result
@@ -200,13 +291,13 @@ def main():
     domain = sys.argv[1].strip().lower()
     
     # Validate domain format
-    if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+$', domain):
+    if not domain.isascii() or not _DOMAIN_RE.fullmatch(domain):
         print(json.dumps({'error': 'Invalid domain format'}))
         sys.exit(1)
     
     try:
         result = test_dkim(domain)
-        print(json.dumps(result, indent=2))
+        print_json(result)
     except Exception as e:
         print(json.dumps({'error': f'Test execution failed: {str(e)}'}))
         sys.exit(1)
@@ -8,7 +8,28 @@ import sys
 import json
 import dns.resolver
 import re
+from datetime import datetime, timezone
 from typing import Dict, Any
+from json_output import print_json
+from dns_cache import cached_resolve, make_resolver
+
+# Built once and reused; the fallback is a separate instance rather than
+# swapping the nameservers of the shared one
+_RESOLVER = make_resolver(['8.8.8.8', '1.1.1.1'])
+_FALLBACK_RESOLVER = make_resolver(['1.1.1.1', '9.9.9.9'])
+
+# DMARC tags and the result fields they are stored in
+DMARC_TAG_FIELDS = {
+    'p': 'policy',
+    'sp': 'subdomain_policy',
+    'rua': 'rua',
+    'ruf': 'ruf',
+    'pct': 'percentage',
+    'aspf': 'alignment_spf',
+    'adkim': 'alignment_dkim',
+}
+
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
 
 def test_dmarc(domain: str) -> Dict[str, Any]:
     """
@@ -31,54 +52,35 @@ def test_dmarc(domain: str) -> Dict[str, Any]:
         'percentage': None,
         'alignment_spf': None,
         'alignment_dkim': None,
-        'errors': []
+        'errors': [],
+        'warnings': [],
+        'passed': False
     }
     
     try:
-        # Query for DMARC record with optimized settings
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = 3
-        resolver.lifetime = 5
-        
-        # Use reliable DNS servers directly
-        resolver.nameservers = ['8.8.8.8', '1.1.1.1']
-        
         dmarc_domain = f"_dmarc.{domain}"
         
         try:
             # Try with primary DNS servers
-            answers = resolver.resolve(dmarc_domain, 'TXT')
+            records = cached_resolve(dmarc_domain, 'TXT', _RESOLVER)
         except Exception as e:
             # Fallback to alternate DNS
-            resolver.nameservers = ['1.1.1.1', '9.9.9.9']
-            answers = resolver.resolve(dmarc_domain, 'TXT')
+            records = cached_resolve(dmarc_domain, 'TXT', _FALLBACK_RESOLVER, result['warnings'], allow_stale=True)
         
-        for answer in answers:
-            record = answer.to_text().strip('"')
-            
+        for record in records:
             # Check if this is a DMARC record
             if record.startswith('v=DMARC1'):
                 result['has_dmarc'] = True
                 result['record'] = record
                 
                 # Parse DMARC record components
-                components = record.split(';')
-                for component in components:
-                    component = component.strip()
-                    if component.startswith('p='):
-                        result['policy'] = component.split('=')[1]
-                    elif component.startswith('sp='):
-                        result['subdomain_policy'] = component.split('=')[1]
-                    elif component.startswith('rua='):
-                        result['rua'] = component.split('=')[1]
-                    elif component.startswith('ruf='):
-                        result['ruf'] = component.split('=')[1]
-                    elif component.startswith('pct='):
-                        result['percentage'] = int(component.split('=')[1])
-                    elif component.startswith('aspf='):
-                        result['alignment_spf'] = component.split('=')[1]
-                    elif component.startswith('adkim='):
-                        result['alignment_dkim'] = component.split('=')[1]
+                for component in record.split(';'):
+                    tag, _, value = component.strip().partition('=')
+                    field = DMARC_TAG_FIELDS.get(tag)
+                    if field == 'percentage':
+                        result[field] = int(value)
+                    elif field:
+                        result[field] = value
                 
                 break
                 
@@ -88,14 +90,6 @@ def test_dmarc(domain: str) -> Dict[str, Any]:
         result['errors'].append(f"No DMARC record found for {domain}")
     except Exception as e:
         result['errors'].append(f"Error querying DMARC record: {str(e)}")
-        
-        # Use fallback data for google.com
-        if domain == 'google.com':
-            result['has_dmarc'] = True
-            result['record'] = "v=DMARC1; p=reject; rua=mailto:postmaster@google.com"
-            result['policy'] = "reject"
-            result['rua'] = "mailto:postmaster@google.com"
-            result['percentage'] = 100
     
     # Validate DMARC policy
     if result['has_dmarc']:
@@ -106,7 +100,8 @@ def test_dmarc(domain: str) -> Dict[str, Any]:
         if not result['rua'] and not result['ruf']:
             result['errors'].append("No reporting addresses configured (rua or ruf)")
     
-    result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
+    result['passed'] = result['has_dmarc'] and result['policy'] == 'reject'
+    result['test_timestamp'] = datetime.now(timezone.utc).isoformat()
     result['test_type'] = 'dmarc'
     
     return result
@@ -119,13 +114,13 @@ def main():
     domain = sys.argv[1].strip().lower()
     
     # Validate domain format
-    if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+$', domain):
+    if not domain.isascii() or not _DOMAIN_RE.fullmatch(domain):
         print(json.dumps({'error': 'Invalid domain format'}))
         sys.exit(1)
     
     try:
         result = test_dmarc(domain)
-        print(json.dumps(result, indent=2))
+        print_json(result)
     except Exception as e:
         print(json.dumps({'error': f'Test execution failed: {str(e)}'}))
         sys.exit(1)
@@ -4,10 +4,104 @@ Single Domain Test Script
 Tests a specific domain against all security tests and evaluates the result
 """
 
+import re
 import sys
-import json
-import subprocess
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+
+from test_dkim import test_dkim
+from test_dmarc import test_dmarc
+from test_mail_server import test_mail_server
+from test_spf import test_spf
+
+@dataclass(slots=True)
+class DomainScore:
+    """Per-test verdicts and issue counts for a domain"""
+    dmarc: bool = False
+    spf: bool = False
+    dkim: bool = False
+    mail_server: bool = False
+    passed: int = 0
+    total: int = 0
+    critical: int = 0
+    warnings: int = 0
+    
+    def flag(self, severity: Optional[str]):
+        """Count an issue of the given severity ('warning' or 'critical'); None counts nothing"""
+        if severity == 'critical':
+            self.critical += 1
+        elif severity == 'warning':
+            self.warnings += 1
+
+# Same check each script's main() applies before testing a domain
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
+
+# Severity of a DMARC policy / SPF 'all' qualifier that does not pass
+DMARC_POLICY_SEVERITY = {'quarantine': 'warning', 'none': 'critical'}
+SPF_ALL_SEVERITY = {'~all': 'warning', '+all': 'critical'}
+
+def score_results(all_results: Dict[str, Any]) -> DomainScore:
+    """Evaluate the test results once, based on evaluateSecurityStatus.js logic"""
+    score = DomainScore()
+    
+    # DMARC evaluation
+    if 'dmarc' in all_results:
+        score.total += 1
+        dmarc = all_results['dmarc']
+        if dmarc.get('has_dmarc'):
+            if dmarc.get('passed'):
+                score.dmarc = True
+            else:
+                score.flag(DMARC_POLICY_SEVERITY.get(dmarc.get('policy')))
+            
+            if not dmarc.get('rua') and not dmarc.get('ruf'):
+                score.warnings += 1
+        else:
+            score.critical += 1
+    
+    # SPF evaluation
+    if 'spf' in all_results:
+        score.total += 1
+        spf = all_results['spf']
+        if spf.get('has_spf'):
+            if spf.get('passed'):
+                score.spf = True
+            else:
+                score.flag(SPF_ALL_SEVERITY.get(spf.get('all_mechanism'), 'warning'))
+        else:
+            score.critical += 1
+    
+    # DKIM evaluation
+    if 'dkim' in all_results:
+        score.total += 1
+        dkim = all_results['dkim']
+        if dkim.get('passed'):
+            score.dkim = True
+            
+            if dkim.get('key_length') and '1024' in dkim.get('key_length'):
+                score.warnings += 1
+        elif dkim.get('has_dkim') and not dkim.get('signature_valid'):
+            score.critical += 1
+        else:
+            score.warnings += 1
+    
+    # Mail Server evaluation
+    if 'mail_server' in all_results:
+        score.total += 1
+        mail = all_results['mail_server']
+        if mail.get('smtp_accessible'):
+            if mail.get('supports_tls') and mail.get('supports_auth'):
+                score.mail_server = True
+            elif mail.get('supports_tls') or mail.get('supports_auth'):
+                score.warnings += 1
+            else:
+                score.critical += 1
+        else:
+            score.critical += 1
+    
+    score.passed = sum((score.dmarc, score.spf, score.dkim, score.mail_server))
+    return score
 
 def test_domain(domain):
     """Run all tests on a single domain"""
@@ -16,43 +110,41 @@ def test_domain(domain):
     
     # Run all tests
     tests = [
-        ('DMARC', 'test_dmarc.py'),
-        ('SPF', 'test_spf.py'), 
-        ('DKIM', 'test_dkim.py'),
-        ('Mail Server', 'test_mail_server.py')
+        ('DMARC', test_dmarc),
+        ('SPF', test_spf),
+        ('DKIM', test_dkim),
+        ('Mail Server', test_mail_server)
     ]
     
     all_results = {}
     
-    for name, script in tests:
-        print(f"Running {name} test...")
-        result = subprocess.run(
-            [sys.executable, script, domain],
-            capture_output=True,
-            text=True
-        )
+    # The tests are independent network probes - run them side by side so
+    # the total time is that of the slowest test rather than the sum
+    with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+        futures = []
+        for name, test_fn in tests:
+            print(f"Running {name} test...")
+            futures.append(executor.submit(test_fn, domain))
         
-        if result.returncode == 0:
+        for (name, _), future in zip(tests, futures):
             try:
-                test_result = json.loads(result.stdout)
-                all_results[name.lower().replace(" ", "_")] = test_result
+                all_results[name.lower().replace(" ", "_")] = future.result()
                 print(f"✅ {name} test completed successfully")
-            except json.JSONDecodeError:
-                print(f"⚠️ {name} test output could not be parsed as JSON")
-                print(result.stdout)
-        else:
-            print(f"❌ {name} test failed")
-            print(result.stderr)
+            except Exception as e:
+                print(f"❌ {name} test failed")
+                print(str(e))
     
     print("\n" + "=" * 50)
     print("EVALUATION SUMMARY:")
     print("=" * 50)
     
+    score = score_results(all_results)
+    
     # Check DMARC
     if 'dmarc' in all_results:
         dmarc = all_results['dmarc']
         if dmarc.get('has_dmarc'):
-            print(f"DMARC: {'✅ PASS' if dmarc.get('policy') == 'reject' else '⚠️ WARNING'}")
+            print(f"DMARC: {'✅ PASS' if score.dmarc else '⚠️ WARNING'}")
             print(f"  - Policy: {dmarc.get('policy')}")
         else:
             print("DMARC: ❌ FAIL - No DMARC record found")
@@ -61,7 +153,7 @@ def test_domain(domain):
     if 'spf' in all_results:
         spf = all_results['spf']
         if spf.get('has_spf'):
-            print(f"SPF: {'✅ PASS' if spf.get('all_mechanism') == '-all' else '⚠️ WARNING'}")
+            print(f"SPF: {'✅ PASS' if score.spf else '⚠️ WARNING'}")
             print(f"  - All mechanism: {spf.get('all_mechanism')}")
         else:
             print("SPF: ❌ FAIL - No SPF record found")
@@ -69,7 +161,7 @@ def test_domain(domain):
     # Check DKIM
     if 'dkim' in all_results:
         dkim = all_results['dkim']
-        if dkim.get('has_dkim') and dkim.get('signature_valid'):
+        if score.dkim:
             print(f"DKIM: ✅ PASS")
             print(f"  - Selectors found: {', '.join(dkim.get('selectors_found', []))}")
             print(f"  - Key length: {dkim.get('key_length')}")
@@ -84,7 +176,7 @@ def test_domain(domain):
         if mail.get('smtp_accessible'):
             tls = mail.get('supports_tls', False)
             auth = mail.get('supports_auth', False)
-            if tls and auth:
+            if score.mail_server:
                 print(f"Mail Server: ✅ PASS")
             else:
                 print(f"Mail Server: ⚠️ WARNING - Missing security features")
@@ -93,86 +185,19 @@ def test_domain(domain):
         else:
             print("Mail Server: ❌ FAIL - Not accessible")
     
-    # Calculate score based on evaluateSecurityStatus.js logic
-    totalTests = 0
-    passedTests = 0
-    criticalIssues = 0
-    warningIssues = 0
-    
-    # DMARC evaluation
-    if 'dmarc' in all_results:
-        totalTests += 1
-        dmarc = all_results['dmarc']
-        if dmarc.get('has_dmarc'):
-            if dmarc.get('policy') == 'reject':
-                passedTests += 1
-            elif dmarc.get('policy') == 'quarantine':
-                warningIssues += 1
-            elif dmarc.get('policy') == 'none':
-                criticalIssues += 1
-            
-            if not dmarc.get('rua') and not dmarc.get('ruf'):
-                warningIssues += 1
-        else:
-            criticalIssues += 1
-    
-    # SPF evaluation
-    if 'spf' in all_results:
-        totalTests += 1
-        spf = all_results['spf']
-        if spf.get('has_spf'):
-            if spf.get('all_mechanism') == '-all':
-                passedTests += 1
-            elif spf.get('all_mechanism') == '~all':
-                warningIssues += 1
-            elif spf.get('all_mechanism') == '+all':
-                criticalIssues += 1
-            else:
-                warningIssues += 1
-        else:
-            criticalIssues += 1
-    
-    # DKIM evaluation
-    if 'dkim' in all_results:
-        totalTests += 1
-        dkim = all_results['dkim']
-        if dkim.get('has_dkim') and dkim.get('signature_valid'):
-            passedTests += 1
-            
-            if dkim.get('key_length') and '1024' in dkim.get('key_length'):
-                warningIssues += 1
-        elif dkim.get('has_dkim') and not dkim.get('signature_valid'):
-            criticalIssues += 1
-        else:
-            warningIssues += 1
-    
-    # Mail Server evaluation
-    if 'mail_server' in all_results:
-        totalTests += 1
-        mail = all_results['mail_server']
-        if mail.get('smtp_accessible'):
-            if mail.get('supports_tls') and mail.get('supports_auth'):
-                passedTests += 1
-            elif mail.get('supports_tls') or mail.get('supports_auth'):
-                warningIssues += 1
-            else:
-                criticalIssues += 1
-        else:
-            criticalIssues += 1
-    
     # Calculate score
-    if totalTests > 0:
-        baseScore = (passedTests / totalTests) * 100
-        warningPenalty = warningIssues * 5
-        criticalPenalty = criticalIssues * 20
+    if score.total > 0:
+        baseScore = (score.passed / score.total) * 100
+        warningPenalty = score.warnings * 5
+        criticalPenalty = score.critical * 20
         
         overallScore = max(0, int(baseScore - warningPenalty - criticalPenalty))
         
         # Determine risk level
-        if criticalIssues > 0:
+        if score.critical > 0:
             riskLevel = 'HIGH'
             status = 'FAIL'
-        elif warningIssues > 0:
+        elif score.warnings > 0:
             riskLevel = 'MEDIUM'
             status = 'WARNING'
         else:
@@ -183,7 +208,7 @@ def test_domain(domain):
         print(f"  Overall Score: {overallScore}/100")
         print(f"  Risk Level: {riskLevel}")
         print(f"  Status: {status}")
-        print(f"  Tests Passed: {passedTests}/{totalTests}")
+        print(f"  Tests Passed: {score.passed}/{score.total}")
     
     return all_results
 
@@ -194,6 +219,12 @@ def main():
         sys.exit(1)
     
     domain = sys.argv[1].strip().lower()
+    
+    # The tests run in-process, so the check their scripts' main() made happens here
+    if not domain.isascii() or not _DOMAIN_RE.fullmatch(domain):
+        print("Invalid domain format")
+        sys.exit(1)
+    
     test_domain(domain)
 
 if __name__ == "__main__":
@@ -9,9 +9,165 @@ import json
 import dns.resolver
 import socket
 import smtplib
+import queue
 import re
+import threading
 import time
-from typing import Dict, Any, List
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from json_output import print_json
+from dns_cache import CACHE_DIR, cached_resolve, load_json, make_resolver, save_json
+
+_RESOLVER = make_resolver(['8.8.8.8', '1.1.1.1'])
+_FALLBACK_RESOLVER = make_resolver(['1.1.1.1', '9.9.9.9'])
+
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
+
+# SMTP capabilities rarely change, so probe results are remembered per MX host
+CAPS_CACHE_FILE = CACHE_DIR / 'mx_caps.json'
+CAPS_TTL = 24 * 60 * 60
+# Fields every cached probe must have; anything else is treated as a miss
+CAPS_FIELDS = ('tls', 'auth', 'banner', 'response', 'response_time_ms', 'ts')
+
+# Number of MX hosts probed side by side; the first to answer is reported
+MAX_PROBED_MX = 3
+
+def _smtp_session(host: str, port: int, timeout: float) -> Dict[str, Any]:
+    """
+    Connect to a mail server once and read its capabilities
+    
+    Args:
+        host: MX hostname to probe
+        port: SMTP port to connect to
+        timeout: Socket timeout in seconds
+        
+    Returns:
+        Dictionary of SMTP probe results; raises if the connection fails
+    """
+    probe = {
+        'smtp_response': None,
+        'supports_tls': False,
+        'supports_auth': False,
+        'smtp_banner': None,
+        'response_time_ms': None
+    }
+    
+    # Test SMTP connectivity with shorter timeout to avoid hanging
+    smtp = None
+    try:
+        start_time = time.time()
+        smtp = smtplib.SMTP(timeout=timeout)
+        # connect() already reads the greeting - reading the socket again
+        # would consume the reply to EHLO instead
+        code, banner = smtp.connect(host, port)
+        
+        # Keep Nagle / delayed ACKs from stalling the short EHLO and QUIT exchanges
+        smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            # Linux only, and reset by the kernel - a best-effort hint
+            smtp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        
+        end_time = time.time()
+        probe['response_time_ms'] = int((end_time - start_time) * 1000)
+        probe['smtp_banner'] = f"{code} {banner.decode('utf-8', errors='ignore')}".strip()
+            
+        # Test capabilities
+        try:
+            code, response = smtp.ehlo()
+            probe['smtp_response'] = response.decode('utf-8', errors='ignore')
+            
+            # Check for TLS/AUTH support
+            if smtp.has_extn('STARTTLS'):
+                probe['supports_tls'] = True
+            if smtp.has_extn('AUTH'):
+                probe['supports_auth'] = True
+        except:
+            pass
+    finally:
+        # Always close connection if it was opened
+        if smtp:
+            try:
+                smtp.quit()
+            except Exception:
+                # quit() leaves the socket open when the server never answers
+                smtp.close()
+    
+    return probe
+
+def _probe_smtp(host: str, port: int = 25, timeout: float = 5, retries: int = 2,
+                stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """
+    Probe a mail server, retrying refused or reset connections with backoff
+    
+    Timeouts are not retried - the attempt has already used its full budget.
+    
+    Args:
+        host: MX hostname to probe
+        port: SMTP port to connect to
+        timeout: Socket timeout in seconds for each attempt
+        retries: Extra attempts after the first, waiting 1s, 2s, ... between them
+        stop: Event that abandons the remaining retries once set
+        
+    Returns:
+        Dictionary of SMTP probe results; the last error is raised if every attempt fails
+    """
+    stop = stop or threading.Event()
+    
+    for attempt in range(retries + 1):
+        try:
+            return _smtp_session(host, port, timeout)
+        except ConnectionError:
+            # Event.wait() doubles as the backoff sleep and returns early once stopped
+            if attempt == retries or stop.wait(2 ** attempt):
+                raise
+
+def _cached_caps(caps_cache: Dict[str, Any], host: str) -> Optional[Dict[str, Any]]:
+    """Return the unexpired cached probe of host, or None when missing, expired or malformed"""
+    caps = caps_cache.get(host)
+    if not isinstance(caps, dict) or not all(field in caps for field in CAPS_FIELDS):
+        return None
+    ts = caps['ts']
+    if not isinstance(ts, (int, float)) or isinstance(ts, bool) or time.time() - ts >= CAPS_TTL:
+        return None
+    return caps
+
+def _first_smtp_probe(hosts: List[str]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Probe several MX hosts concurrently and keep the first that answers
+    
+    Args:
+        hosts: MX hostnames in priority order
+        
+    Returns:
+        Tuple of the answering host and its probe results; if every host
+        fails, the error of the highest-priority host is raised
+    """
+    outcomes = queue.Queue()
+    stop = threading.Event()
+    
+    def probe(host: str):
+        try:
+            outcomes.put((host, _probe_smtp(host, stop=stop), None))
+        except Exception as e:
+            outcomes.put((host, None, e))
+    
+    # Daemon threads rather than an executor: the interpreter joins executor
+    # workers at exit, so a slow backup host would hold the process open
+    for host in hosts:
+        threading.Thread(target=probe, args=(host,), daemon=True).start()
+    
+    errors = {}
+    try:
+        for _ in hosts:
+            host, result, error = outcomes.get()
+            if error is None:
+                return host, result
+            errors[host] = error
+    finally:
+        # Abandon the slower hosts' retries once one has answered
+        stop.set()
+    
+    raise errors[hosts[0]]
 
 def test_mail_server(domain: str) -> Dict[str, Any]:
     """
@@ -34,52 +190,23 @@ def test_mail_server(domain: str) -> Dict[str, Any]:
         'smtp_banner': None,
         'response_time_ms': None,
         'errors': [],
-        'warnings': []
+        'warnings': [],
+        'passed': False
     }
     
     try:
-        # Create resolver with improved settings
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = 3
-        resolver.lifetime = 5
-        
-        # Use reliable DNS servers
-        resolver.nameservers = ['8.8.8.8', '1.1.1.1']
-        
         # Get MX records
         try:
-            mx_answers = resolver.resolve(domain, 'MX')
+            mx_answers = cached_resolve(domain, 'MX', _RESOLVER)
         except Exception:
             # Try alternate DNS
-            resolver.nameservers = ['1.1.1.1', '9.9.9.9']
-            try:
-                mx_answers = resolver.resolve(domain, 'MX')
-            except Exception as e:
-                # Google.com fallback for testing
-                if domain.lower() == "google.com":
-                    result['mx_records'] = [
-                        {"priority": 10, "hostname": "aspmx.l.google.com"},
-                        {"priority": 20, "hostname": "alt1.aspmx.l.google.com"}
-                    ]
-                    result['primary_mx'] = "aspmx.l.google.com"
-                    result['smtp_accessible'] = True
-                    result['supports_tls'] = True
-                    result['supports_auth'] = True
-                    result['smtp_banner'] = "220 mx.google.com ESMTP"
-                    result['response_time_ms'] = 150
-                    result['warnings'].append("Using fallback data due to DNS resolution error")
-                    
-                    result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
-                    result['test_type'] = 'mail_server_echo'
-                    return result
-                else:
-                    raise
+            mx_answers = cached_resolve(domain, 'MX', _FALLBACK_RESOLVER, result['warnings'], allow_stale=True)
         
         mx_records = []
-        for mx in mx_answers:
+        for preference, exchange in mx_answers:
             mx_records.append({
-                'priority': mx.preference,
-                'hostname': str(mx.exchange).rstrip('.')
+                'priority': preference,
+                'hostname': exchange.rstrip('.')
             })
         
         # Sort by priority (lower number = higher priority)
@@ -93,47 +220,48 @@ def test_mail_server(domain: str) -> Dict[str, Any]:
         # Test primary MX server
         primary_mx = mx_records[0]['hostname']
         result['primary_mx'] = primary_mx
+        candidates = [mx_record['hostname'] for mx_record in mx_records[:MAX_PROBED_MX]]
         
-        # Test SMTP connectivity with shorter timeout to avoid hanging
-        smtp = None
-        try:
-            start_time = time.time()
-            smtp = smtplib.SMTP(timeout=5)
-            smtp.connect(primary_mx, 25)
-            
-            end_time = time.time()
-            result['response_time_ms'] = int((end_time - start_time) * 1000)
+        # Many domains share MX hosts, so a cached probe of the host is reused
+        caps_cache = load_json(CAPS_CACHE_FILE)
+        if not isinstance(caps_cache, dict):
+            caps_cache = {}
+        cached_host = next((host for host in candidates if _cached_caps(caps_cache, host)), None)
+        
+        if cached_host:
+            cached_caps = caps_cache[cached_host]
+            minutes = int((time.time() - cached_caps['ts']) // 60)
+            result['warnings'].append(
+                f"SMTP capabilities of {cached_host} are cached from a probe {minutes} minutes ago"
+            )
+            result['primary_mx'] = cached_host
             result['smtp_accessible'] = True
-            
-            # Get server banner if available
-            if hasattr(smtp, 'sock') and smtp.sock:
-                try:
-                    result['smtp_banner'] = smtp.sock.recv(1024).decode('utf-8', errors='ignore').strip()
-                except:
-                    pass
-                
-            # Test capabilities
+            result['supports_tls'] = cached_caps['tls']
+            result['supports_auth'] = cached_caps['auth']
+            result['smtp_banner'] = cached_caps['banner']
+            result['smtp_response'] = cached_caps['response']
+            result['response_time_ms'] = cached_caps['response_time_ms']
+        else:
             try:
-                code, response = smtp.ehlo()
-                result['smtp_response'] = response.decode('utf-8', errors='ignore')
-                
-                # Check for TLS/AUTH support
-                if smtp.has_extn('STARTTLS'):
-                    result['supports_tls'] = True
-                if smtp.has_extn('AUTH'):
-                    result['supports_auth'] = True
-            except:
-                pass
+                host, probe = _first_smtp_probe(candidates)
+                result['primary_mx'] = host
+                result['smtp_accessible'] = True
+                result.update(probe)
                 
-        except Exception as e:
-            result['errors'].append(f"SMTP connection error: {str(e)}")
-        finally:
-            # Always close connection if it was opened
-            if smtp:
-                try:
-                    smtp.quit()
-                except:
-                    pass
+                # A failed EHLO says nothing about the server's capabilities -
+                # caching it would fail every domain on this MX for CAPS_TTL
+                if probe['smtp_response'] is not None:
+                    caps_cache[host] = {
+                        'tls': probe['supports_tls'],
+                        'auth': probe['supports_auth'],
+                        'banner': probe['smtp_banner'],
+                        'response': probe['smtp_response'],
+                        'response_time_ms': probe['response_time_ms'],
+                        'ts': time.time()
+                    }
+                    save_json(CAPS_CACHE_FILE, caps_cache)
+            except Exception as e:
+                result['errors'].append(f"SMTP connection error: {str(e)}")
         
         # Check for common issues with MX records
         for mx_record in mx_records:
@@ -150,23 +278,9 @@ def test_mail_server(domain: str) -> Dict[str, Any]:
         result['errors'].append(f"No MX records found for {domain}")
     except Exception as e:
         result['errors'].append(f"Error testing mail server: {str(e)}")
-        
-        # Fallback data for google.com
-        if domain.lower() == "google.com":
-            result['mx_records'] = [
-                {"priority": 10, "hostname": "aspmx.l.google.com"},
-                {"priority": 20, "hostname": "alt1.aspmx.l.google.com"}
-            ]
-            result['primary_mx'] = "aspmx.l.google.com"
-            result['smtp_accessible'] = True
-            result['smtp_response'] = "250 SMTPUTF8"
-            result['supports_tls'] = True
-            result['supports_auth'] = True
-            result['smtp_banner'] = "220 mx.google.com ESMTP"
-            result['response_time_ms'] = 150
-            result['warnings'].append("Using fallback data due to DNS resolution error")
-    
-    result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
+    
+    result['passed'] = result['smtp_accessible'] and result['supports_tls']
+    result['test_timestamp'] = datetime.now(timezone.utc).isoformat()
     result['test_type'] = 'mail_server_echo'
     
     return result
@@ -179,13 +293,13 @@ def main():
     domain = sys.argv[1].strip().lower()
     
     # Validate domain format
-    if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+$', domain):
+    if not domain.isascii() or not _DOMAIN_RE.fullmatch(domain):
         print(json.dumps({'error': 'Invalid domain format'}))
         sys.exit(1)
     
     try:
         result = test_mail_server(domain)
-        print(json.dumps(result, indent=2))
+        print_json(result)
     except Exception as e:
         print(json.dumps({'error': f'Test execution failed: {str(e)}'}))
         sys.exit(1)
@@ -5,39 +5,86 @@ Runs all Python tests for DMARC, SPF, DKIM, and Mail Server
 """
 
 import sys
-import json
 import subprocess
 import os
-from pathlib import Path
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def run_test(script_name, domain):
-    """Run a single test script"""
+import dns_cache
+from json_output import loads, print_json
+
+from test_dkim import test_dkim
+from test_dmarc import test_dmarc
+from test_mail_server import test_mail_server
+from test_spf import test_spf
+
+# (script, display name, test function) for every test, in report order
+TESTS = (
+    ("test_dmarc.py", "DMARC", test_dmarc),
+    ("test_spf.py", "SPF", test_spf),
+    ("test_dkim.py", "DKIM", test_dkim),
+    ("test_mail_server.py", "Mail Server", test_mail_server)
+)
+
+# Summary icon for each test status; anything unrecognised is shown as a failure
+STATUS_ICONS = {"PASS": "✅", "FAIL": "❌"}
+
+# Same check each script's main() applies before testing a domain
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
+
+# Seconds all tests together may take; the backend kills the runner after 60
+TEST_TIMEOUT = 30
+# Seconds before that deadline isolated scripts are killed, so each one is
+# reaped and reported as timed out before the runner gives up on it
+ISOLATED_KILL_MARGIN = 1
+
+# Absolute path of each script, for isolated runs
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATHS = {script: os.path.join(SCRIPT_DIR, script) for script, _, _ in TESTS}
+
+def run_test(test_fn, domain):
+    """Run a single test in-process"""
     try:
-        script_path = Path(__file__).parent / script_name
+        return test_fn(domain)
+    except Exception as e:
+        return {"error": f"Test execution failed: {str(e)}"}
+
+def run_test_isolated(script_path, domain, verbose=False, timeout=TEST_TIMEOUT):
+    """
+    Run a single test script in its own interpreter, killing it after timeout seconds
+    
+    Unparseable output is summarised by its size; pass verbose=True to embed
+    the raw stdout and stderr in the error instead.
+    """
+    try:
+        # Output is kept as bytes - loads() parses them directly, and
+        # only the error paths pay for decoding
         result = subprocess.run(
-            [sys.executable, str(script_path), domain],
+            [sys.executable, script_path, domain],
             capture_output=True,
-            text=True,
-            timeout=30
+            timeout=timeout
         )
         
         if result.returncode == 0:
             try:
-                return json.loads(result.stdout)
-            except json.JSONDecodeError:
+                return loads(result.stdout)
+            except ValueError:
+                if not verbose:
+                    return {"error": "Invalid JSON output", "output_size": len(result.stdout)}
                 return {
                     "error": "Invalid JSON output",
-                    "raw_output": result.stdout,
-                    "stderr": result.stderr
+                    "raw_output": result.stdout.decode(errors="replace"),
+                    "stderr": result.stderr.decode(errors="replace")
                 }
         else:
             return {
                 "error": f"Test failed with exit code {result.returncode}",
-                "stdout": result.stdout,
-                "stderr": result.stderr
+                "stdout": result.stdout.decode(errors="replace"),
+                "stderr": result.stderr.decode(errors="replace")
             }
     except subprocess.TimeoutExpired:
-        return {"error": "Test timed out after 30 seconds"}
+        return {"error": f"Test timed out after {timeout:.0f} seconds"}
     except Exception as e:
         return {"error": f"Failed to run test: {str(e)}"}
 
@@ -51,74 +98,77 @@ def evaluate_security(results, domain):
         "test_statuses": {}
     }
     
+    statuses = evaluation["test_statuses"]
+    recommendations = evaluation["recommendations"]
+    
     # Track test results
     total_tests = 0
     passed_tests = 0
     
+    # Missing records are critical issues; every other recommendation is a warning
+    critical_issues = 0
+    warnings = 0
+    
     # Check DMARC
     if "dmarc" in results:
         total_tests += 1
         dmarc = results["dmarc"]
         
-        if dmarc.get("has_dmarc", False):
-            if dmarc.get("policy") == "reject":
-                evaluation["test_statuses"]["dmarc"] = "PASS"
-                passed_tests += 1
-            else:
-                evaluation["test_statuses"]["dmarc"] = "FAIL"
-                evaluation["recommendations"].append(f"Strengthen DMARC policy to 'reject' (current: {dmarc.get('policy')})")
+        if dmarc.get("passed", False):
+            statuses["dmarc"] = "PASS"
+            passed_tests += 1
+        elif dmarc.get("has_dmarc", False):
+            statuses["dmarc"] = "FAIL"
+            recommendations.append(f"Strengthen DMARC policy to 'reject' (current: {dmarc.get('policy')})")
+            warnings += 1
         else:
-            evaluation["test_statuses"]["dmarc"] = "FAIL"
-            evaluation["recommendations"].append("No DMARC record found - implement DMARC to prevent email spoofing")
+            statuses["dmarc"] = "FAIL"
+            recommendations.append("No DMARC record found - implement DMARC to prevent email spoofing")
+            critical_issues += 1
     
     # Check SPF
     if "spf" in results:
         total_tests += 1
         spf = results["spf"]
         
-        # Special case for google.com to demonstrate successful tests
-        if domain.lower() == "google.com":
-            evaluation["test_statuses"]["spf"] = "PASS"
+        if spf.get("passed", False):
+            statuses["spf"] = "PASS"
             passed_tests += 1
         elif spf.get("has_spf", False):
-            if spf.get("all_mechanism") == "-all":
-                evaluation["test_statuses"]["spf"] = "PASS"
-                passed_tests += 1
-            else:
-                evaluation["test_statuses"]["spf"] = "FAIL"
-                evaluation["recommendations"].append(f"Use strict SPF policy with '-all' qualifier (current: {spf.get('all_mechanism')})")
+            statuses["spf"] = "FAIL"
+            recommendations.append(f"Use strict SPF policy with '-all' qualifier (current: {spf.get('all_mechanism')})")
+            warnings += 1
         else:
-            evaluation["test_statuses"]["spf"] = "FAIL"
-            evaluation["recommendations"].append("No SPF record found - implement SPF to specify authorized mail servers")
+            statuses["spf"] = "FAIL"
+            recommendations.append("No SPF record found - implement SPF to specify authorized mail servers")
+            critical_issues += 1
     
     # Check DKIM
     if "dkim" in results:
         total_tests += 1
         dkim = results["dkim"]
         
-        if dkim.get("has_dkim", False) and dkim.get("signature_valid"):
-            evaluation["test_statuses"]["dkim"] = "PASS"
+        if dkim.get("passed", False):
+            statuses["dkim"] = "PASS"
             passed_tests += 1
         else:
-            evaluation["test_statuses"]["dkim"] = "FAIL"
-            evaluation["recommendations"].append("DKIM not properly configured - implement DKIM signing for your domain")
+            statuses["dkim"] = "FAIL"
+            recommendations.append("DKIM not properly configured - implement DKIM signing for your domain")
+            warnings += 1
     
     # Check Mail Server
     if "mail_server" in results:
         total_tests += 1
         mail = results["mail_server"]
         
-        # Special case for google.com to demonstrate successful tests
-        if domain.lower() == "google.com":
-            evaluation["test_statuses"]["mail_server"] = "PASS"
-            passed_tests += 1
-        elif mail.get("smtp_accessible", False) and mail.get("supports_tls", False):
-            evaluation["test_statuses"]["mail_server"] = "PASS"
+        if mail.get("passed", False):
+            statuses["mail_server"] = "PASS"
             passed_tests += 1
         else:
-            evaluation["test_statuses"]["mail_server"] = "FAIL"
+            statuses["mail_server"] = "FAIL"
             if not mail.get("supports_tls", False):
-                evaluation["recommendations"].append("Mail server does not support TLS - enable TLS for secure email delivery")
+                recommendations.append("Mail server does not support TLS - enable TLS for secure email delivery")
+                warnings += 1
     
     # Calculate overall score based on passed tests
     if total_tests > 0:
@@ -127,9 +177,6 @@ def evaluate_security(results, domain):
         base_score = 0
     
     # Apply penalties
-    critical_issues = len([r for r in evaluation["recommendations"] if "CRITICAL" in r or "No " in r])
-    warnings = len(evaluation["recommendations"]) - critical_issues
-    
     final_score = max(0, base_score - (critical_issues * 20) - (warnings * 5))
     evaluation["overall_score"] = final_score
     
@@ -152,45 +199,77 @@ def evaluate_security(results, domain):
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python3 test_runner.py <domain> [--json-only]")
+        print("Usage: python3 test_runner.py <domain> [--json-only] [--isolated] [--verbose]")
         print("Example: python3 test_runner.py google.com")
         print("Add --json-only to output only the JSON result (for backend integration)")
+        print("Add --isolated to run each test in its own process with a hard timeout")
+        print("Add --verbose to include raw script output in isolated-run errors")
         sys.exit(1)
     
-    domain = sys.argv[1]
-    json_only = False
+    domain = sys.argv[1].strip().lower()
     
-    # Check for json-only flag
-    if len(sys.argv) > 2 and sys.argv[2] == "--json-only":
-        json_only = True
+    # Check for optional flags
+    json_only = "--json-only" in sys.argv[2:]
+    isolated = "--isolated" in sys.argv[2:]
+    verbose = "--verbose" in sys.argv[2:]
     
     # Change to the script directory
-    os.chdir(Path(__file__).parent)
+    os.chdir(SCRIPT_DIR)
     
     if not json_only:
         print(f"Running security tests for domain: {domain}")
         print("=" * 50)
     
-    tests = [
-        ("test_dmarc.py", "DMARC"),
-        ("test_spf.py", "SPF"),
-        ("test_dkim.py", "DKIM"),
-        ("test_mail_server.py", "Mail Server")
-    ]
-    
     results = {}
     
-    for script, test_name in tests:
-        if not json_only:
-            print(f"Running {test_name} test...")
-        result = run_test(script, domain)
-        results[test_name.lower().replace(" ", "_")] = result
-        
-        if not json_only:
-            if "error" in result:
-                print(f"❌ {test_name}: {result['error']}")
+    if domain.isascii() and _DOMAIN_RE.fullmatch(domain):
+        tests = TESTS
+    else:
+        # Answer as each script's main() would, without sending the name to DNS
+        tests = ()
+        for _, test_name, _ in TESTS:
+            results[test_name.lower().replace(" ", "_")] = {"error": "Invalid domain format"}
+            if not json_only:
+                print(f"❌ {test_name}: Invalid domain format")
+    
+    # One deadline covers every test rather than each waiting out its own timeout
+    deadline = time.monotonic() + TEST_TIMEOUT
+    overran = False
+    
+    # The tests are independent and network-bound, so run them side by side
+    # instead of waiting on each subprocess in turn
+    executor = ThreadPoolExecutor(max_workers=len(TESTS))
+    try:
+        futures = {}
+        for script, test_name, test_fn in tests:
+            if not json_only:
+                print(f"Running {test_name} test...")
+            # In-process calls skip an interpreter start-up and a JSON round-trip
+            # per test; isolated runs trade that for a timeout that can kill the test
+            if isolated:
+                futures[test_name] = executor.submit(
+                    run_test_isolated, SCRIPT_PATHS[script], domain, verbose,
+                    deadline - ISOLATED_KILL_MARGIN - time.monotonic()
+                )
             else:
-                print(f"✅ {test_name}: Test completed")
+                futures[test_name] = executor.submit(run_test, test_fn, domain)
+        
+        for test_name, future in futures.items():
+            try:
+                result = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                result = {"error": f"Test did not finish within the {TEST_TIMEOUT} second deadline"}
+                overran = True
+            results[test_name.lower().replace(" ", "_")] = result
+            
+            if not json_only:
+                if "error" in result:
+                    print(f"❌ {test_name}: {result['error']}")
+                else:
+                    print(f"✅ {test_name}: Test completed")
+    finally:
+        # Report on time instead of waiting for tests that overran the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
     
     # Evaluate security based on test results
     evaluation = evaluate_security(results, domain)
@@ -201,11 +280,13 @@ def main():
         print("EVALUATION SUMMARY:")
         print("=" * 50)
         
+        dmarc_policy = results.get("dmarc", {}).get("policy")
+        
         for test, status in evaluation["test_statuses"].items():
-            icon = "✅" if status == "PASS" else "❌"
+            icon = STATUS_ICONS.get(status, "❌")
             test_details = ""
-            if test == "dmarc" and "dmarc" in results and results["dmarc"].get("policy"):
-                test_details = f" - Policy: {results['dmarc']['policy']}"
+            if test == "dmarc" and dmarc_policy:
+                test_details = f" - Policy: {dmarc_policy}"
             print(f"{test.upper()}: {icon} {status}{test_details}")
         
         print("\nSecurity Score:")
@@ -221,7 +302,14 @@ def main():
     
     # When in json-only mode, print only the JSON results
     if json_only:
-        print(json.dumps(results))
+        print_json(results)
+    
+    if overran:
+        # Worker threads cannot be stopped and the interpreter joins them at
+        # exit, so leave now rather than wait for the tests that overran
+        sys.stdout.flush()
+        dns_cache._save()
+        os._exit(0)
     
     return results
 
@@ -8,7 +8,22 @@ import sys
 import json
 import dns.resolver
 import re
+from datetime import datetime, timezone
 from typing import Dict, Any, List
+from json_output import print_json
+from dns_cache import cached_resolve, make_resolver
+
+# Built once and reused, one instance per set of nameservers tried in turn.
+# Each gets 2s per nameserver and 3s in total, so the whole chain stays under 10s
+_RESOLVER = make_resolver(['8.8.8.8', '1.1.1.1'], timeout=2, lifetime=3)
+_CLOUDFLARE_RESOLVER = make_resolver(['1.1.1.1', '1.0.0.1'], timeout=2, lifetime=3)
+_QUAD9_RESOLVER = make_resolver(['9.9.9.9', '149.112.112.112'], timeout=2, lifetime=3)
+
+# SPF mechanisms whose value is collected, and the result lists they go to
+SPF_LIST_FIELDS = {'include': 'includes', 'ip4': 'ip4_addresses', 'ip6': 'ip6_addresses'}
+SPF_ALL_MECHANISMS = {'~all', '-all', '+all', '?all'}
+
+_DOMAIN_RE = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+')
 
 def test_spf(domain: str) -> Dict[str, Any]:
     """
@@ -31,35 +46,27 @@ def test_spf(domain: str) -> Dict[str, Any]:
         'mx_records': False,
         'all_mechanism': None,
         'errors': [],
-        'warnings': []
+        'warnings': [],
+        'passed': False
     }
     
     try:
-        # Query for TXT records with a custom resolver and longer timeout
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = 5
-        resolver.lifetime = 5
-        
-        # Use Google DNS directly - more reliable
-        resolver.nameservers = ['8.8.8.8', '1.1.1.1']
-        
         try:
-            answers = resolver.resolve(domain, 'TXT')
+            records = cached_resolve(domain, 'TXT', _RESOLVER)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            # A definitive answer - other resolvers would only repeat it
+            raise
         except Exception as e:
             # Try Cloudflare DNS as fallback
             result['warnings'].append(f"Trying alternative DNS: {str(e)}")
-            resolver.nameservers = ['1.1.1.1', '1.0.0.1']
             try:
-                answers = resolver.resolve(domain, 'TXT')
+                records = cached_resolve(domain, 'TXT', _CLOUDFLARE_RESOLVER)
             except Exception as e2:
                 # One more attempt with Quad9
-                resolver.nameservers = ['9.9.9.9', '149.112.112.112']
-                answers = resolver.resolve(domain, 'TXT')
+                records = cached_resolve(domain, 'TXT', _QUAD9_RESOLVER, result['warnings'], allow_stale=True)
         
         spf_records = []
-        for answer in answers:
-            record = answer.to_text().strip('"')
-            
+        for record in records:
             # Check if this is an SPF record
             if record.startswith('v=spf1'):
                 spf_records.append(record)
@@ -79,23 +86,16 @@ def test_spf(domain: str) -> Dict[str, Any]:
             # Parse SPF mechanisms
             mechanisms = spf_record.split()
             for mechanism in mechanisms[1:]:  # Skip 'v=spf1'
-                mechanism = mechanism.strip()
+                name, sep, value = mechanism.partition(':')
                 
-                if mechanism.startswith('include:'):
-                    result['includes'].append(mechanism[8:])
-                elif mechanism.startswith('ip4:'):
-                    result['ip4_addresses'].append(mechanism[4:])
-                elif mechanism.startswith('ip6:'):
-                    result['ip6_addresses'].append(mechanism[4:])
+                if sep and name in SPF_LIST_FIELDS:
+                    result[SPF_LIST_FIELDS[name]].append(value)
                 elif mechanism == 'mx':
                     result['mx_records'] = True
-                elif mechanism in ['~all', '-all', '+all', '?all']:
+                elif mechanism in SPF_ALL_MECHANISMS:
                     result['all_mechanism'] = mechanism
-                elif mechanism.startswith('a:') or mechanism == 'a':
-                    # A record mechanism
-                    pass
-                elif mechanism.startswith('exists:'):
-                    # Exists mechanism
+                elif mechanism == 'a' or (sep and name in ('a', 'exists')):
+                    # A record and exists mechanisms
                     pass
                 else:
                     result['warnings'].append(f"Unknown or complex mechanism: {mechanism}")
@@ -120,17 +120,9 @@ def test_spf(domain: str) -> Dict[str, Any]:
         result['errors'].append(f"No TXT records found for {domain}")
     except Exception as e:
         result['errors'].append(f"Error querying SPF record: {str(e)}")
-        
-        # Set pass-through dummy data for testing purposes
-        # This ensures the security evaluation doesn't fail completely during network issues
-        result['has_spf'] = True
-        result['record'] = "v=spf1 include:_spf.google.com -all"
-        result['mechanism'] = "v=spf1 include:_spf.google.com -all"
-        result['includes'] = ["_spf.google.com"]
-        result['all_mechanism'] = "-all"
-        result['warnings'].append("Using fallback SPF data due to DNS resolution error")
     
-    result['test_timestamp'] = __import__('datetime').datetime.now().isoformat()
+    result['passed'] = result['has_spf'] and result['all_mechanism'] == '-all'
+    result['test_timestamp'] = datetime.now(timezone.utc).isoformat()
     result['test_type'] = 'spf'
     
     return result
@@ -143,13 +135,13 @@ def main():
     domain = sys.argv[1].strip().lower()
     
     # Validate domain format
-    if not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9-]{1,61}[a-zA-Z0-9](?:\.[a-zA-Z]{2,})+$', domain):
+    if not domain.isascii() or not _DOMAIN_RE.fullmatch(domain):
         print(json.dumps({'error': 'Invalid domain format'}))
         sys.exit(1)
     
     try:
         result = test_spf(domain)
-        print(json.dumps(result, indent=2))
+        print_json(result)
     except Exception as e:
         print(json.dumps({'error': f'Test execution failed: {str(e)}'}))
         sys.exit(1)